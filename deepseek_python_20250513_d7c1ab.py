@@ -1,69 +1,396 @@
+import hashlib
+import io
+import os
+import tempfile
+import time
+from pathlib import Path
+
+import duckdb
 import streamlit as st
+import numpy as np
 import pandas as pd
 import plotly.express as px
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
+from numba import njit, prange
+
+DATE_COLS = ["Order Date", "Invoice Date", "Payment Status Date"]
+DATE_FORMATS = ["%Y-%m-%d", "%Y-%m-%dT%H:%M:%S", "%Y-%m-%d %H:%M:%S", "%d/%m/%Y", "%m/%d/%Y"]
+# Nominal Rupiah tetap float64 (float32 hanya ~7 digit presisi); Qty cukup int32
+NUMERIC_TYPES = {"Total Payment": pa.float64(), "Discount": pa.float64(), "Qty": pa.int32()}
+CATEGORY_COLS = ["Payment Status", "Product Name", "Partner"]
+# Semua kolom yang dipakai panel dashboard; ekspor tetap memuat semua kolom CSV
+USED_COLS = DATE_COLS + ["TrxID", "Total Payment", "Discount", "Qty", "Payment Status", "Product Name", "Partner"]
+# Cache berisi salinan upload pengguna: default di direktori temp, bisa diatur lewat env
+CACHE_DIR = Path(os.environ.get("SALES_DASHBOARD_CACHE_DIR", Path(tempfile.gettempdir()) / "sales_dashboard_cache"))
+CACHE_MAX_BYTES = 1024**3  # 1 GiB
+CACHE_MAX_AGE = 7 * 24 * 60 * 60  # 7 hari
+# Naikkan setiap kali isi file cache berubah (mis. prepare() diubah) agar cache lama tidak terbaca
+CACHE_VERSION = 2
+# Batas cache per filter (digest, tanggal mulai, tanggal akhir) di memori server;
+# hasil ekspor berisi seluruh data terfilter sehingga dibatasi lebih ketat
+FILTER_CACHE_ENTRIES = 64
+EXPORT_CACHE_ENTRIES = 4
+EXPORT_CACHE_TTL = 10 * 60  # detik
 
 st.set_page_config(page_title="Sales Dashboard", layout="wide")
+
+
+def to_naive_ns(series):
+    # Seragamkan ke datetime64[ns] tanpa zona waktu; timestamp ber-zona dikonversi ke UTC dulu
+    dtype = series.dtype
+    tz = dtype.pyarrow_dtype.tz if isinstance(dtype, pd.ArrowDtype) else getattr(dtype, "tz", None)
+    if tz is not None:
+        series = series.dt.tz_convert(None)
+    return series.astype("datetime64[ns]")
+
+
+def to_date(series):
+    # Parse dengan format eksplisit (strptime C, cache=True: tanggal yang sama cukup
+    # di-parse sekali). Format dipakai hanya jika cocok untuk seluruh kolom dan hanya
+    # satu format yang cocok; d/m/Y vs m/d/Y yang sama-sama valid diserahkan ke inferensi.
+    if pd.api.types.is_datetime64_any_dtype(series.dtype):
+        return to_naive_ns(series)
+    missing = series.isna().sum()
+    sample = series.dropna().iloc[:1000]
+    matches = []
+    for fmt in DATE_FORMATS:
+        # Sampel hanya untuk menyaring format yang jelas salah sebelum cek seluruh kolom
+        if pd.to_datetime(sample, format=fmt, errors="coerce").isna().any():
+            continue
+        parsed = pd.to_datetime(series, format=fmt, cache=True, errors="coerce")
+        if parsed.isna().sum() == missing:
+            matches.append(parsed)
+    if len(matches) == 1:
+        return to_naive_ns(matches[0])
+    # utc=True: offset campuran tidak menghasilkan kolom object
+    return to_naive_ns(pd.to_datetime(series, cache=True, errors="coerce", utc=True))
+
+
+@njit(parallel=True, cache=True)
+def parse_money(offsets, data, out):
+    # Satu loop atas byte UTF-8 buffer Arrow; "$", ",", dan spasi dilewati,
+    # teks lain menghasilkan NaN (seperti errors="coerce")
+    for i in prange(out.shape[0]):
+        value = 0.0
+        scale = 1.0
+        sign = 1.0
+        digits = 0
+        point = False
+        valid = True
+        for j in range(offsets[i], offsets[i + 1]):
+            c = data[j]
+            if 48 <= c <= 57:  # 0-9
+                value = value * 10.0 + (c - 48)
+                digits += 1
+                if point:
+                    scale *= 10.0
+            elif c == 46 and not point:  # "."
+                point = True
+            elif c == 45 and digits == 0 and sign > 0:  # "-"
+                sign = -1.0
+            elif not (c == 36 or c == 44 or c == 32 or c == 9):  # "$", ",", spasi, tab
+                valid = False
+                break
+        out[i] = sign * value / scale if valid and digits > 0 else np.nan
+
+
+def to_number(series, dtype):
+    # Kolom teks di-parse langsung dari buffer Arrow oleh parse_money, lalu cast ke tipe tujuan
+    arr = pa.array(series, from_pandas=True)
+    if isinstance(arr, pa.ChunkedArray):
+        arr = arr.combine_chunks()
+    if pa.types.is_string(arr.type) or pa.types.is_large_string(arr.type):
+        _, offsets, data = arr.buffers()
+        offset_type = np.int64 if pa.types.is_large_string(arr.type) else np.int32
+        offsets = np.frombuffer(offsets, dtype=offset_type)[arr.offset:arr.offset + len(arr) + 1]
+        data = np.frombuffer(data, dtype=np.uint8) if data is not None else np.empty(0, dtype=np.uint8)
+        values = np.empty(len(arr), dtype=np.float64)
+        parse_money(offsets, data, values)
+        arr = pa.array(values, mask=np.isnan(values) | arr.is_null().to_numpy(zero_copy_only=False))
+    # Nilai pecahan (mis. Qty 2.5) tidak boleh terpotong: tetap float64
+    if pa.types.is_integer(dtype) and pa.types.is_floating(arr.type) and not pc.all(pc.equal(pc.floor(arr), arr)).as_py():
+        dtype = pa.float64()
+    return pd.Series(pd.arrays.ArrowExtensionArray(pc.cast(arr, dtype)), index=series.index, name=series.name)
+
+
+def cache_path(digest, kind):
+    # kind "orders": kolom dashboard yang sudah dibersihkan (dibaca pandas dan DuckDB)
+    # kind "full": semua kolom CSV dengan tanggal ter-parse, urutan baris asli (untuk ekspor)
+    return CACHE_DIR / f"{digest}.{kind}.v{CACHE_VERSION}.parquet"
+
+
+def write_parquet(df, path):
+    # Tulis ke file sementara lalu os.replace: sesi paralel atau crash tidak
+    # pernah meninggalkan file Parquet setengah jadi di path akhir
+    fd, tmp_path = tempfile.mkstemp(dir=path.parent, suffix=".tmp")
+    os.close(fd)
+    try:
+        df.to_parquet(tmp_path, index=False, compression="zstd", row_group_size=256_000)
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+
+
+def evict_cache(keep):
+    # Hapus file versi lama dan yang lebih tua dari CACHE_MAX_AGE, lalu file yang paling
+    # lama tidak dipakai selama total ukuran melebihi CACHE_MAX_BYTES. File milik upload
+    # aktif (keep) dan file sementara yang masih ditulis sesi lain dipertahankan.
+    current = f".v{CACHE_VERSION}.parquet"
+    now = time.time()
+    entries = []
+    total = 0
+    for path in CACHE_DIR.iterdir():
+        try:
+            stat = path.stat()
+        except FileNotFoundError:
+            continue
+        expired = now - stat.st_mtime > CACHE_MAX_AGE
+        if path.suffix == ".tmp":
+            if expired:
+                path.unlink(missing_ok=True)
+        elif path.name.startswith(f"{keep}.") and path.name.endswith(current):
+            total += stat.st_size
+        elif expired or not path.name.endswith(current):
+            path.unlink(missing_ok=True)
+        else:
+            entries.append((stat.st_mtime, stat.st_size, path))
+            total += stat.st_size
+    for _, size, path in sorted(entries):
+        if total <= CACHE_MAX_BYTES:
+            break
+        path.unlink(missing_ok=True)
+        total -= size
+
+
+def prepare(df):
+    # Konversi tanggal
+    for col in DATE_COLS:
+        if col in df.columns:
+            df[col] = to_date(df[col])
+
+    # Bersihkan kolom angka ("$1,250.00" -> 1250.0)
+    for col, dtype in NUMERIC_TYPES.items():
+        if col in df.columns:
+            df[col] = to_number(df[col], dtype)
+
+    # Kolom kategori: disimpan sebagai dictionary di Parquet, kode integer di pandas
+    for col in CATEGORY_COLS:
+        if col in df.columns:
+            df[col] = df[col].astype("category")
+
+    # Urutkan sekali: row group Parquet dan index pandas sama-sama terurut per tanggal
+    return df.dropna(subset=["Order Date"]).sort_values("Order Date")
+
+
+def ensure_cache(file_bytes, digest):
+    # Simpan Parquet per isi file; CSV hanya di-parse sekali. Tidak di-cache: dijalankan
+    # setiap rerun karena evict_cache bisa menghapus file milik sesi yang masih terbuka.
+    orders_path = cache_path(digest, "orders")
+    full_path = cache_path(digest, "full")
+    try:
+        # mtime menandai kapan file terakhir dipakai, untuk evict_cache
+        os.utime(orders_path)
+        os.utime(full_path)
+        return
+    except FileNotFoundError:
+        pass
+
+    CACHE_DIR.mkdir(parents=True, exist_ok=True)
+    # Salinan lengkap untuk pratinjau dan ekspor: semua kolom, tanggal ter-parse
+    raw = pd.read_csv(io.BytesIO(file_bytes), engine="pyarrow", dtype_backend="pyarrow")
+    for col in DATE_COLS:
+        if col in raw.columns:
+            raw[col] = to_date(raw[col])
+    write_parquet(raw, full_path)
+    del raw
+
+    # Panel dashboard: hanya kolom USED_COLS yang dikonversi dan dialokasikan
+    header = pd.read_csv(io.BytesIO(file_bytes), nrows=0).columns
+    usecols = [c for c in header if c in USED_COLS]
+    orders = pd.read_csv(io.BytesIO(file_bytes), usecols=usecols, engine="pyarrow", dtype_backend="pyarrow")
+    write_parquet(prepare(orders), orders_path)
+    evict_cache(keep=digest)
+
+
+@st.cache_data(show_spinner=False)
+def load_data(digest):
+    # Yang di-cache hanya ringkasan kecil untuk halaman; data lengkap tetap di Parquet dan
+    # dibaca DuckDB. File orders terurut per tanggal: batas tanggal = baris pertama/terakhir.
+    path = cache_path(digest, "orders")
+    dates = pq.read_table(path, columns=["Order Date"]).column("Order Date")
+    return {"columns": pq.read_schema(path).names, "start": dates[0].as_py(), "end": dates[-1].as_py()}
+
+
+@st.cache_data(show_spinner=False)
+def load_preview(digest):
+    # Pratinjau dari salinan lengkap: semua kolom CSV, urutan baris dan kolom asli
+    batches = pq.ParquetFile(cache_path(digest, "full")).iter_batches(batch_size=5)
+    return next(batches).to_pandas()
+
+
+@st.cache_resource
+def get_connection():
+    return duckdb.connect()
+
+
+def query(select, key, clauses=""):
+    # Agregasi dijalankan DuckDB langsung di atas Parquet (pushdown kolom dan filter
+    # tanggal ke row group). Satu cursor per query agar koneksi bersama aman lintas sesi.
+    digest, start_date, end_date = key
+    path = str(cache_path(digest, "orders")).replace("'", "''")
+    sql = f"SELECT {select} FROM read_parquet('{path}') WHERE \"Order Date\" BETWEEN ? AND ? {clauses}"
+    params = [pd.to_datetime(start_date), pd.to_datetime(end_date)]
+    return get_connection().cursor().execute(sql, params).df()
+
+
+def qty_sum(key):
+    # sum(INTEGER) di DuckDB bertipe HUGEINT yang menjadi float64 di .df(); cast ke BIGINT
+    # jika Qty integer agar tampil 4, bukan 4.0 (Qty pecahan tetap DOUBLE)
+    qty_type = pq.read_schema(cache_path(key[0], "orders")).field("Qty").type
+    return "sum(Qty)::BIGINT" if pa.types.is_integer(qty_type) else "sum(Qty)"
+
+
+# Agregasi di-cache per filter, key = (digest file, tanggal mulai, tanggal akhir)
+@st.cache_data(show_spinner=False, max_entries=FILTER_CACHE_ENTRIES)
+def sales_summary(key):
+    row = query(
+        'count(DISTINCT TrxID) AS trx, coalesce(sum("Total Payment"), 0) AS payment, '
+        f"coalesce(sum(Discount), 0) AS discount, coalesce({qty_sum(key)}, 0) AS qty",
+        key,
+    ).iloc[0]
+    # iloc[0] menyatukan kolom int dan float menjadi float64; jumlah transaksi dikembalikan ke int
+    return {"trx": int(row["trx"]), "payment": row["payment"], "discount": row["discount"], "qty": row["qty"]}
+
+
+@st.cache_data(show_spinner=False, max_entries=FILTER_CACHE_ENTRIES)
+def monthly_trend(key):
+    return query(
+        "date_trunc('month', \"Order Date\") AS Bulan, sum(\"Total Payment\") AS \"Total Payment\"",
+        key,
+        "GROUP BY 1 ORDER BY 1",
+    )
+
+
+@st.cache_data(show_spinner=False, max_entries=FILTER_CACHE_ENTRIES)
+def payment_distribution(key):
+    return query(
+        '"Payment Status" AS Status, count(*) AS Jumlah',
+        key,
+        'AND "Payment Status" IS NOT NULL GROUP BY 1 ORDER BY 2 DESC',
+    )
+
+
+@st.cache_data(show_spinner=False, max_entries=FILTER_CACHE_ENTRIES)
+def top_products(key):
+    return query(
+        f'"Product Name", {qty_sum(key)} AS Qty',
+        key,
+        'AND "Product Name" IS NOT NULL GROUP BY 1 ORDER BY 2 DESC LIMIT 10',
+    )
+
+
+@st.cache_data(show_spinner=False, max_entries=FILTER_CACHE_ENTRIES)
+def partner_performance(key):
+    return query(
+        f'Partner, sum("Total Payment") AS "Total Payment", {qty_sum(key)} AS Qty',
+        key,
+        "AND Partner IS NOT NULL GROUP BY 1 ORDER BY 2 DESC",
+    ).set_index("Partner")
+
+
+# Figure Plotly ikut di-cache per filter: rerun tanpa perubahan filter tidak membangun ulang figure
+@st.cache_data(show_spinner=False, max_entries=FILTER_CACHE_ENTRIES)
+def trend_chart(key):
+    return px.line(monthly_trend(key), x="Bulan", y="Total Payment", title="Tren Pembayaran Bulanan", markers=True)
+
+
+@st.cache_data(show_spinner=False, max_entries=FILTER_CACHE_ENTRIES)
+def payment_chart(key):
+    return px.pie(payment_distribution(key), values="Jumlah", names="Status", title="Distribusi Status Pembayaran")
+
+
+@st.cache_data(show_spinner=False, max_entries=FILTER_CACHE_ENTRIES)
+def top_products_chart(key):
+    return px.bar(top_products(key), x="Qty", y="Product Name", orientation="h", title="Top 10 Produk Terjual")
+
+
+def export_frame(key):
+    # Semua kolom CSV dalam urutan aslinya; filter tanggal di-pushdown ke row group Parquet
+    digest, start_date, end_date = key
+    return pd.read_parquet(
+        cache_path(digest, "full"),
+        engine="pyarrow",
+        filters=[("Order Date", ">=", pd.to_datetime(start_date)), ("Order Date", "<=", pd.to_datetime(end_date))],
+    )
+
+
+@st.cache_data(show_spinner=False, max_entries=EXPORT_CACHE_ENTRIES, ttl=EXPORT_CACHE_TTL)
+def export_csv(key):
+    return export_frame(key).to_csv(index=False).encode("utf-8")
+
+
+@st.cache_data(show_spinner=False, max_entries=EXPORT_CACHE_ENTRIES, ttl=EXPORT_CACHE_TTL)
+def export_parquet(key):
+    buffer = io.BytesIO()
+    export_frame(key).to_parquet(buffer, index=False, compression="zstd")
+    return buffer.getvalue()
+
+
 st.title("📊 Sales Dashboard - Analisis Penjualan")
 
 # Upload CSV
 uploaded_file = st.file_uploader("📁 Unggah file CSV", type=["csv"])
 if uploaded_file:
     try:
-        df = pd.read_csv(uploaded_file)
-
-        # Konversi tanggal
-        for col in ["Order Date", "Invoice Date", "Payment Status Date"]:
-            if col in df.columns:
-                df[col] = pd.to_datetime(df[col], errors="coerce")
+        file_bytes = uploaded_file.getvalue()
+        digest = hashlib.sha256(file_bytes).hexdigest()
+        ensure_cache(file_bytes, digest)
+        overview = load_data(digest)
 
         st.subheader("🔍 Pratinjau Data")
-        st.dataframe(df.head())
+        st.dataframe(load_preview(digest))
 
         # Sidebar filters
         st.sidebar.header("🎛️ Filter Data")
-        start_date = st.sidebar.date_input("Mulai Tanggal", value=df["Order Date"].min())
-        end_date = st.sidebar.date_input("Akhir Tanggal", value=df["Order Date"].max())
+        start_date = st.sidebar.date_input("Mulai Tanggal", value=overview["start"])
+        end_date = st.sidebar.date_input("Akhir Tanggal", value=overview["end"])
 
-        # Filter berdasarkan tanggal
-        df_filtered = df[(df["Order Date"] >= pd.to_datetime(start_date)) & 
-                         (df["Order Date"] <= pd.to_datetime(end_date))]
+        # Filter berdasarkan tanggal: diterapkan oleh query DuckDB dan ekspor per key
+        key = (digest, start_date, end_date)
 
         # Ringkasan
         st.subheader("📌 Ringkasan Penjualan")
+        summary = sales_summary(key)
         col1, col2, col3, col4 = st.columns(4)
-        col1.metric("🧾 Total Transaksi", f"{df_filtered['TrxID'].nunique():,}")
-        col2.metric("💰 Total Pembayaran", f"Rp {df_filtered['Total Payment'].sum():,.0f}")
-        col3.metric("🎯 Total Diskon", f"Rp {df_filtered['Discount'].sum():,.0f}")
-        col4.metric("📦 Jumlah Produk Terjual", f"{df_filtered['Qty'].sum():,.0f}")
+        col1.metric("🧾 Total Transaksi", f"{summary['trx']:,}")
+        col2.metric("💰 Total Pembayaran", f"Rp {summary['payment']:,.0f}")
+        col3.metric("🎯 Total Diskon", f"Rp {summary['discount']:,.0f}")
+        col4.metric("📦 Jumlah Produk Terjual", f"{summary['qty']:,.0f}")
 
         # Tren penjualan per bulan
         st.subheader("📅 Tren Penjualan per Bulan")
-        df_filtered["Bulan"] = df_filtered["Order Date"].dt.to_period("M").astype(str)
-        trend = df_filtered.groupby("Bulan")["Total Payment"].sum().reset_index()
-        fig = px.line(trend, x="Bulan", y="Total Payment", title="Tren Pembayaran Bulanan", markers=True)
-        st.plotly_chart(fig, use_container_width=True)
+        st.plotly_chart(trend_chart(key), use_container_width=True, key="trend_chart")
 
         # Pie chart status pembayaran
-        if "Payment Status" in df_filtered.columns:
+        if "Payment Status" in overview["columns"]:
             st.subheader("💳 Distribusi Status Pembayaran")
-            payment_pie = df_filtered["Payment Status"].value_counts().reset_index()
-            payment_pie.columns = ["Status", "Jumlah"]
-            fig2 = px.pie(payment_pie, values="Jumlah", names="Status", title="Distribusi Status Pembayaran")
-            st.plotly_chart(fig2, use_container_width=True)
+            st.plotly_chart(payment_chart(key), use_container_width=True, key="payment_chart")
 
         # Bar chart produk terlaris
         st.subheader("🏆 Produk Terlaris")
-        top_products = df_filtered.groupby("Product Name")["Qty"].sum().nlargest(10).reset_index()
-        fig3 = px.bar(top_products, x="Qty", y="Product Name", orientation="h", title="Top 10 Produk Terjual")
-        st.plotly_chart(fig3, use_container_width=True)
+        st.plotly_chart(top_products_chart(key), use_container_width=True, key="top_products_chart")
 
         # Tabel per partner atau PIC
         st.subheader("📈 Kinerja Partner")
-        partner_summary = df_filtered.groupby("Partner")[["Total Payment", "Qty"]].sum().sort_values("Total Payment", ascending=False)
-        st.dataframe(partner_summary)
+        st.dataframe(partner_performance(key))
 
         # Export
-        st.download_button("⬇️ Unduh Data yang Difilter", df_filtered.to_csv(index=False).encode("utf-8"), file_name="hasil_filter.csv")
+        col1, col2 = st.columns(2)
+        col1.download_button("⬇️ Unduh Data yang Difilter (CSV)", export_csv(key), file_name="hasil_filter.csv")
+        col2.download_button("⬇️ Unduh Data yang Difilter (Parquet)", export_parquet(key), file_name="hasil_filter.parquet")
 
     except Exception as e:
         st.error(f"Terjadi kesalahan: {str(e)}")